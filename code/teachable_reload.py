@@ -178,8 +178,9 @@ class UI_EdgeTpuDevBoard(UI):
     super(UI_EdgeTpuDevBoard, self).__init__()
 
   def __del__(self):
-    if hasattr(self, "_LEDs"):
-      for x in self._LEDs or [] + self._buttons or []: x.close()
+    for x in (getattr(self, "_LEDs", None) or []) + (getattr(self, "_buttons", None) or []):
+      try: x.close()
+      except Exception: pass
 
   def setLED(self, index, state):
     """Abstracts away mix of GPIO and PWM LEDs."""
@@ -15,24 +15,36 @@
 # limitations under the License.
 
 import argparse
+import array
 import sys
 import os
 import time
 
 from abc import abstractmethod
-from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 os.environ['XDG_RUNTIME_DIR']='/run/user/1000'
 
 from embedding import KNNEmbeddingEngine
-from PIL import Image
 
 import gstreamer
 import shutil
 
 import cv2
 import threading
+import queue
+import numpy as np
+
+try:
+  from numba import njit, prange
+except ImportError:   # numba is optional, the engine falls back to numpy
+  njit = None
+
+try:
+  from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:   # turbojpeg is optional, reload_data falls back to cv2
+  TurboJPEG = None
 
 def detectPlatform():
   try:
@@ -49,17 +61,65 @@ def detectPlatform():
     return "unknown"
 
 
+### Modify by Chun
+def put_latest(q, item):
+  """Puts item into the bounded queue q, dropping the oldest entry if q is full.
+
+     Must only be called by the single producer of q. Returns the dropped
+     entry, or None.
+  """
+  dropped = None
+  try:
+    q.put_nowait(item)
+  except queue.Full:
+    try:
+      dropped = q.get_nowait()
+    except queue.Empty:   # the consumer got there first
+      pass
+    q.put_nowait(item)
+  return dropped
+
+def pin_thread(core, nice=0):
+  """Pins the calling thread to one CPU core and adds `nice` to its nice level."""
+  try:
+    os.sched_setaffinity(0, {core})   # pid 0 : only the calling thread on Linux
+  except (AttributeError, OSError) as e:
+    print('Could not pin thread to CPU %d: %s'%(core, e))
+  if nice:
+    try:
+      os.nice(nice)
+    except OSError as e:   # raising the priority needs root
+      print('Could not change thread priority: %s'%e)
+### End of Modify
+
+
 class UI(object):
   """Abstract UI class. Subclassed by specific board implementations."""
   def __init__(self):
-    self._button_state = [False for _ in self._buttons]
+    self._button_state = array.array('b', [0]*len(self._buttons))
     current_time = time.time()
     self._button_state_last_change = [current_time for _ in self._buttons]
     self._debounce_interval = 0.1 # seconds
+    self._raw_button_state = None # latest polled state, None when not polling
+    self._button_bits = 0 # debounced state packed as bits, button i -> bit i
+
+  def startPolling(self, interval=0.02):
+    """Reads the buttons every `interval` seconds from a background thread,
+       so getDebouncedButtonState() only reads the latest snapshot."""
+    self._raw_button_state = self.getButtonState()
+    threading.Thread(target=self._pollButtons, daemon=True, args=(interval,)).start()
+
+  def _pollButtons(self, interval):
+    while True:
+      self._raw_button_state = self.getButtonState()
+      time.sleep(interval)
+
+  def setAllLEDs(self, mask):
+    """Sets every LED at once: LED i is on iff bit i of mask is set."""
+    for i in range(len(self._LEDs)): self.setLED(i, bool(mask >> i & 1))
 
   def setOnlyLED(self, index):
-    for i in range(len(self._LEDs)): self.setLED(i, False)
-    if index is not None: self.setLED(index, True)
+    self.setAllLEDs(0 if index is None else 1 << index)
 
   def isButtonPressed(self, index):
     buttons = self.getButtonState()
@@ -73,33 +133,41 @@ class UI(object):
 
   def getDebouncedButtonState(self):
     t = time.time()
-    for i,new in enumerate(self.getButtonState()):
+    raw = self._raw_button_state
+    if raw is None: raw = self.getButtonState()
+    bits = 0
+    for i,new in enumerate(raw):
       if not new:
-        self._button_state[i] = False
+        self._button_state[i] = 0
         continue
       old = self._button_state[i]
       if ((t-self._button_state_last_change[i]) >
              self._debounce_interval) and not old:
-        self._button_state[i] = True
+        self._button_state[i] = 1
+        bits |= 1 << i
       else:
-        self._button_state[i] = False
+        self._button_state[i] = 0
       self._button_state_last_change[i] = t
+    self._button_bits = bits
     return self._button_state
 
+  def allClassButtonsPressed(self):
+    """True if the last debounced state had buttons 1-4 pressed and not 0."""
+    return self._button_bits == 0b11110
+
   def testButtons(self):
     while True:
-      for i in range(5):
-        self.setLED(i, self.isButtonPressed(i))
-      print('Buttons: ', ' '.join([str(i) for i,v in
-          enumerate(self.getButtonState()) if v]))
+      pressed = [i for i,v in enumerate(self.getButtonState()) if v]
+      self.setAllLEDs(sum(1 << i for i in pressed))
+      print('Buttons: ', ' '.join([str(i) for i in pressed]))
       time.sleep(0.01)
 
   def wiggleLEDs(self, reps=3):
-    for i in range(reps):
+    for _ in range(reps):
       for i in range(5):
-        self.setLED(i, True)
+        self.setAllLEDs(1 << i)
         time.sleep(0.05)
-        self.setLED(i, False)
+    self.setAllLEDs(0)
 
 
 class UI_Keyboard(UI):
@@ -144,6 +212,7 @@ class UI_Raspberry(UI):
       rpigpio.setwarnings(False)
       rpigpio.setup(pin, rpigpio.OUT)
     super(UI_Raspberry, self).__init__()
+    self.startPolling()
 
   def setLED(self, index, state):
     return rpigpio.output(self._LEDs[index],
@@ -179,10 +248,12 @@ class UI_EdgeTpuDevBoard(UI):
       sys.exit(1)
 
     super(UI_EdgeTpuDevBoard, self).__init__()
+    self.startPolling()
 
   def __del__(self):
-    if hasattr(self, "_LEDs"):
-      for x in self._LEDs or [] + self._buttons or []: x.close()
+    for x in (getattr(self, "_LEDs", None) or []) + (getattr(self, "_buttons", None) or []):
+      try: x.close()
+      except Exception: pass
 
   def setLED(self, index, state):
     """Abstracts away mix of GPIO and PWM LEDs."""
@@ -193,75 +264,300 @@ class UI_EdgeTpuDevBoard(UI):
     return [button.read() for button in self._buttons]
 
 
+### Modify by Chun
+if njit is not None:
+  @njit(cache=True, fastmath=True, parallel=True)
+  def knn_classify(emb_i8, labels, n, query_i8, k, max_label):
+    """Returns the most common label among the k rows of emb_i8[:n] with the
+       largest dot product with query_i8.
+
+       Labels with fewer than k examples must already be padded to k rows in
+       emb_i8 (see KNNEmbeddingEngine_ByChun), the vote counts rows as is.
+    """
+    scores = np.empty(n, np.int64)
+    for i in prange(n):
+      s = 0
+      for d in range(emb_i8.shape[1]):
+        s += np.int64(emb_i8[i, d]) * np.int64(query_i8[d])
+      scores[i] = s
+    # Partial top-k selection: top_i holds the best rows so far, best first.
+    k = min(k, n)
+    top_s = np.empty(k, np.int64)
+    top_i = np.empty(k, np.int64)
+    filled = 0
+    for i in range(n):
+      s = scores[i]
+      if filled == k and s <= top_s[k-1]: continue
+      j = filled if filled < k else k-1
+      while j > 0 and top_s[j-1] < s:
+        top_s[j] = top_s[j-1]
+        top_i[j] = top_i[j-1]
+        j -= 1
+      top_s[j] = s
+      top_i[j] = i
+      if filled < k: filled += 1
+    votes = np.zeros(max_label+1, np.int64)
+    for j in range(k):
+      votes[labels[top_i[j]]] += 1
+    return votes.argmax()
+else:
+  knn_classify = None
+
+
+class KNNEmbeddingEngine_ByChun(KNNEmbeddingEngine):
+  """KNNEmbeddingEngine that also accepts preprocessed numpy frames.
+
+     The embedding store is kept as one contiguous row-major int8 matrix of
+     normalized embeddings (symmetric quantization, scale 1/127) plus a
+     parallel int8 array of labels, so a query is a single integer
+     matrix-vector product instead of a rebuild of per-label blocks.
+
+     As upstream, a label with fewer than kNN examples is padded up to kNN
+     rows with copies of its examples, otherwise labels that have more
+     examples unfairly win. The padding is done at insert time: the first
+     example of a label fills kNN rows and later examples overwrite those
+     copies until the label has kNN real examples.
+  """
+
+  _INIT_CAPACITY = 64   # rows allocated on first insert, doubled when full
+
+  def __init__(self, model_path, kNN=3):
+    KNNEmbeddingEngine.__init__(self, model_path, kNN)
+    # Staging buffer in the model's input layout, reused for BGR frames
+    self._input = np.empty(tuple(self.get_input_tensor_shape()[1:]), np.uint8)
+    if knn_classify is not None:   # compile now so the first frame doesn't stall
+      knn_classify(np.zeros((1, 1), np.int8), np.zeros(1, np.int8), 1,
+                   np.zeros(1, np.int8), kNN, 0)
+
+  def DetectWithArray(self, arr, bgr=False):
+    """Returns the embedding of a C-contiguous uint8 (224, 224, 3) array.
+
+       The array is RGB unless bgr is True, in which case the channel swap is
+       done while copying into the preallocated input buffer.
+    """
+    if bgr:
+      np.copyto(self._input, arr[:, :, ::-1])
+      arr = self._input
+    return self.run_inference(arr.reshape(-1))[1]
+
+  def clear(self):
+    """Clear the store: forgets all stored embeddings (keeps the allocation)."""
+    self._n = 0          # rows in the store, including padding copies
+    self._count = 0      # real examples in the store
+    self._pad_rows = {}  # label -> rows holding padding copies for that label
+    self._max_label = 0
+    if not hasattr(self, '_emb_i8'):
+      self._emb_i8 = None
+      self._labels = None
+
+  def _reserve(self, rows, dim):
+    """Makes sure the store can hold at least `rows` embeddings of size `dim`."""
+    if self._emb_i8 is None:
+      capacity = max(self._INIT_CAPACITY, rows)
+      self._emb_i8 = np.empty((capacity, dim), np.int8)
+      self._labels = np.empty(capacity, np.int8)
+    elif rows > self._emb_i8.shape[0]:
+      capacity = self._emb_i8.shape[0]
+      while capacity < rows: capacity *= 2
+      emb = np.empty((capacity, dim), np.int8)
+      labels = np.empty(capacity, np.int8)
+      emb[:self._n] = self._emb_i8[:self._n]
+      labels[:self._n] = self._labels[:self._n]
+      self._emb_i8, self._labels = emb, labels
+
+  @staticmethod
+  def _quantize(emb):
+    """Normalizes an embedding (or each row of a batch) and quantizes it to
+       int8 with scale 1/127."""
+    # Fold normalization and quantization scale into a single multiply
+    scale = 127/np.sqrt(np.einsum('...d,...d->...', emb, emb))
+    return np.clip(np.round(emb*scale[..., None]), -127, 127).astype(np.int8)
+
+  def _append(self, rows, label):
+    """Appends quantized rows, all with the same label, to the store."""
+    n = self._n + rows.shape[0]
+    self._reserve(n, rows.shape[1])
+    self._emb_i8[self._n:n] = rows
+    self._labels[self._n:n] = label
+    self._n = n
+
+  def _insert(self, row, label):
+    """Inserts one quantized example, keeping the label padded to kNN rows."""
+    pad = self._pad_rows.get(label)
+    if pad is None:   # first example of this label: fill kNN rows with it
+      self._pad_rows[label] = list(range(self._n+1, self._n+self._kNN))
+      self._append(np.broadcast_to(row, (self._kNN, row.shape[0])), label)
+    elif pad:         # replace one of the padding copies
+      self._emb_i8[pad.pop()] = row
+    else:
+      self._append(row[None], label)
+    self._count += 1
+    self._max_label = max(self._max_label, label)
+
+  def addEmbedding(self, emb, label):
+    """Add an embedding vector to the store."""
+    self._insert(self._quantize(emb), int(label))
+
+  def addEmbeddings(self, embs, labels):
+    """Add a batch of embedding vectors (one per row) to the store."""
+    rows = self._quantize(embs)
+    for label in np.unique(labels):
+      label = int(label)
+      label_rows = rows[labels == label]
+      # Go through _insert while the label still needs padding, then append
+      # the remaining rows in one copy.
+      i = 0
+      while i < len(label_rows) and self._pad_rows.get(label, True):
+        self._insert(label_rows[i], label)
+        i += 1
+      if i < len(label_rows):
+        self._append(label_rows[i:], label)
+        self._count += len(label_rows) - i
+
+  def kNNEmbedding(self, query_emb):
+    """Returns the most common label among the kNN nearest stored embeddings."""
+    # If we have nothing stored, the answer is None
+    if self._n == 0: return None
+    # Stored embeddings were normalized when added, only the query needs it.
+    query_i8 = self._quantize(query_emb)
+    if knn_classify is not None:
+      return int(knn_classify(self._emb_i8, self._labels, self._n, query_i8,
+                              self._kNN, self._max_label))
+    # Cosine similarity (scaled by 127**2) to every stored embedding in one
+    # matrix-vector product, accumulated in int32 so the int8 products
+    # cannot overflow.
+    scores = np.matmul(self._emb_i8[:self._n], query_i8, dtype=np.int32)
+    kNN = min(self._n, self._kNN)
+    n_argmax = np.argpartition(-scores, kNN-1)[:kNN]
+    return int(np.bincount(self._labels[n_argmax]).argmax())
+
+  def exampleCount(self):
+    """Returns the number of examples in the store, not counting padding."""
+    return self._count
+### End of Modify
+
+
 class TeachableMachine(object):
   """Abstract TeachableMachine class. Subclassed by specific method implementations."""
+  _CLASSES = ('--', 'One', 'Two', 'Three', 'Four')
+  _STATUS_TMPL = 'fps {:.1f}; #examples: {}; Class {:>7s}'
+
   @abstractmethod
   def __init__(self, model_path, ui):
     assert os.path.isfile(model_path), 'Model file %s not found'%model_path
     self._ui = ui
     self._start_time = time.time()
-    self._frame_times = deque(maxlen=40)
+    self._last_frame_ns = 0   # set by the first _update_status call
+    self._ema_dt = 0.0   # exponential moving average of the frame interval, seconds
+    self._led_classification = -1   # classification currently shown on the LEDs
+
+  def _update_status(self, classification):
+    now = time.monotonic_ns()
+    if self._last_frame_ns:   # the first frame only starts the clock
+      dt = (now - self._last_frame_ns)*1e-9
+      self._ema_dt = 0.9*self._ema_dt + 0.1*dt if self._ema_dt else dt
+    self._last_frame_ns = now
+    fps = 1.0/self._ema_dt if self._ema_dt else 0.0
+    # Only touch the LEDs when the classification changes
+    if classification != self._led_classification:
+      self._ui.setOnlyLED(classification)
+      self._led_classification = classification
+    name = self._CLASSES[classification or 0]
+    return self._STATUS_TMPL.format(fps, self._engine.exampleCount(), name), name
 
   def visualize(self, classification, svg):
-    self._frame_times.append(time.time())
-    fps = len(self._frame_times)/float(self._frame_times[-1] - self._frame_times[0] + 0.001)
     # Print/Display results
-    self._ui.setOnlyLED(classification)
-    classes = ['--', 'One', 'Two', 'Three', 'Four']
-    status = 'fps %.1f; #examples: %d; Class % 7s'%(
-            fps, self._engine.exampleCount(),
-            classes[classification or 0])
+    status, _ = self._update_status(classification)
     print(status)
     svg.add(svg.text(status, insert=(26, 26), fill='black', font_size='20'))
     svg.add(svg.text(status, insert=(25, 25), fill='white', font_size='20'))
   
   def get_results(self, classification):
-    self._frame_times.append(time.time())
-    fps = len(self._frame_times)/float(self._frame_times[-1] - self._frame_times[0] + 0.001)
-    # Print/Display results
-    self._ui.setOnlyLED(classification)
-    classes = ['--', 'One', 'Two', 'Three', 'Four']
-    status = 'fps %.1f; #examples: %d; Class % 7s'%(
-            fps, self._engine.exampleCount(),
-            classes[classification or 0])
-    return status, classes[classification or 0]
+    return self._update_status(classification)
 
   def classify(self):
     raise NotImplementedError()
 
+  def close(self):
+    """Finishes any pending work before the program exits."""
+    pass
+
 class TeachableMachineKNN_ByChun(TeachableMachine):
+
+  _MAX_REUSE_NS = 200*1000*1000   # re-run inference at least every 200 ms
   
-  def __init__(self, model_path, ui, KNN=3):
+  def __init__(self, model_path, ui, KNN=3, sad_threshold=0):
     TeachableMachine.__init__(self, model_path, ui)
-    self._buffer = deque(maxlen = 4)
-    self._engine = KNNEmbeddingEngine(model_path, KNN)
+    # Frames whose 16x16 thumbnail differs from the last inferred frame by a
+    # sum of absolute differences below sad_threshold reuse its result (0 = off)
+    self._sad_threshold = sad_threshold
+    self._prev_small = None
+    self._last_emb = None
+    self._last_label = 0
+    self._last_infer_ns = 0
+    self._ring = np.zeros(4, np.int8)   # labels of the last 4 frames (power of 2), 0 = no label
+    self._ring_i = 0
+    self._engine = KNNEmbeddingEngine_ByChun(model_path, KNN)
     
     ### Modify
     self.cls_nums = KNN+1
+    self._vote = np.zeros(self.cls_nums+1, np.int32)   # votes per label in _ring
+    self._vote[0] = len(self._ring)
     self.data_path = 'data_0119'
-    self.trg_folder = []    # trg_folder = './data/{Class}'
+    self.trg_folder = [os.path.join(self.data_path, str(cls)) for cls in range(1, self.cls_nums+1)]    # trg_folder = './data/{Class}'
     self.img_nums = [0, 0, 0, 0]    # img_nums = [ x, x, x, x], count each class's images
+    self._next_idx = [0, 0, 0, 0]   # file index for each class's next saved image
     self.check_dir()
+
+    # Saved images are JPEG encoded and written by a background thread
+    self._save_q = queue.Queue(maxsize=32)   # (save_path, BGR image)
+    threading.Thread(target=self._save_worker, daemon=True, args=()).start()
     
     if sum(self.img_nums) != 0:
       print('\n', 'Reload Data', end=' ... ')
       self.reload_data()
     ### End of Modify
     
+  @staticmethod
+  def _sample_index(name):
+    """Returns N for a saved sample named 'N.jpg', None for any other file."""
+    stem, ext = os.path.splitext(name)
+    return int(stem) if ext == '.jpg' and stem.isdecimal() else None
+
   def check_dir(self):
     
     print('\n', 'Check Dir', end=' ... ')
     for cls in range(1, self.cls_nums+1):  # Classes from 1 to 4
-      self.trg_folder.append(os.path.join(self.data_path, str(cls)))
       
       # Check Directory is existed or not 
       if os.path.exists(self.trg_folder[cls-1]) is False:
         os.makedirs(self.trg_folder[cls-1])
         self.img_nums[cls-1] = 0
+        self._next_idx[cls-1] = 0
       else:
-        self.img_nums[cls-1] = len(os.listdir(self.trg_folder[cls-1]))
+        # Count the images and find the next free index in a single pass,
+        # so deleted files never make a new image overwrite an old one.
+        count, next_idx = 0, 0
+        with os.scandir(self.trg_folder[cls-1]) as it:
+          for entry in it:
+            idx = self._sample_index(entry.name)
+            if idx is None or not entry.is_file(): continue
+            count += 1
+            next_idx = max(next_idx, idx+1)
+        self.img_nums[cls-1] = count
+        self._next_idx[cls-1] = next_idx
   
+  def _save_worker(self):
+    while True:
+      save_path, img = self._save_q.get()
+      cv2.imwrite(save_path, img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+      self._save_q.task_done()
+
+  def close(self):
+    self._save_q.join()   # write every queued sample before exiting
+
   def clear_dir(self):
+    self._save_q.join()   # let pending saves finish before removing the folder
     shutil.rmtree(self.data_path) 
     self.check_dir()
     print('\n\n Clear \n\n')
@@ -269,40 +565,107 @@ class TeachableMachineKNN_ByChun(TeachableMachine):
   def reload_data(self):
 
     t_start = time.time()
+    paths, labels = [], []
     for cls in range(1, self.cls_nums+1):  # 1 ~ 4
-      if self.img_nums[cls-1] != 0 :
-        for idx in range(0, self.img_nums[cls-1]):
-          img = Image.open(os.path.join(self.trg_folder[cls-1], f'{idx}.jpg'))
-          emb = self._engine.DetectWithImage(img)
-          self._buffer.append(self._engine.kNNEmbedding(emb))
-          classification = Counter(self._buffer).most_common(1)[0][0]
-          self._engine.addEmbedding(emb, cls)
+      with os.scandir(self.trg_folder[cls-1]) as it:
+        for entry in it:
+          if self._sample_index(entry.name) is None or not entry.is_file(): continue
+          paths.append(entry.path)
+          labels.append(cls)
+
+    # Decode every saved sample into one preallocated RGB batch. Both
+    # libjpeg-turbo and cv2 release the GIL while decoding, so file reads and
+    # decodes of different samples overlap.
+    tj = None
+    if TurboJPEG is not None:
+      try:
+        tj = TurboJPEG()
+      except (OSError, RuntimeError):   # python module present, shared library missing
+        pass
+    imgs = np.empty((len(paths), 224, 224, 3), np.uint8)
+    def decode(i):
+      """Decodes paths[i] into imgs[i], returns False if it can't be read."""
+      if tj is not None:
+        try:
+          with open(paths[i], 'rb') as f:
+            img = tj.decode(f.read(), pixel_format=TJPF_RGB)
+        except OSError:
+          img = None
+      else:
+        img = cv2.imread(paths[i])
+      if img is None:
+        print('\n', 'Skip unreadable image', paths[i], end='')
+        return False
+      cv2.resize(img, (224, 224), dst=imgs[i])   # samples of any size fit the slot
+      if tj is None: cv2.cvtColor(imgs[i], cv2.COLOR_BGR2RGB, dst=imgs[i])
+      return True
+    with ThreadPoolExecutor(max_workers=4) as pool:
+      ok = np.fromiter(pool.map(decode, range(len(paths))), bool, len(paths))
+
+    keep = np.flatnonzero(ok)   # index rather than mask, so the batch isn't copied
+    if keep.size:
+      embs = np.stack([self._engine.DetectWithArray(imgs[i]) for i in keep])
+      self._engine.addEmbeddings(embs, np.array(labels, np.int8)[keep])
     print('Done({:.3f}s)'.format(time.time()-t_start))       
     
   def classify(self, img):
-        
-    # Classify current image and determine
-    emb = self._engine.DetectWithImage(img)
-    self._buffer.append(self._engine.kNNEmbedding(emb))
-    classification = Counter(self._buffer).most_common(1)[0][0]
+    arr = np.asarray(img.convert('RGB'), dtype=np.uint8)
+    _, h, w, _ = self._engine.get_input_tensor_shape()
+    if arr.shape[:2] != (h, w):   # match the model input like DetectWithImage did
+      arr = cv2.resize(arr, (w, h), interpolation=cv2.INTER_NEAREST)
+    return self.classify_array(arr)
+
+  def classify_array(self, img, bgr=False):
+    """Same as classify() but takes the frame as a uint8 numpy array, RGB
+       unless bgr is True."""
+    # Classify current image and determine, skipping inference when the
+    # scene hasn't changed since the last inferred frame
+    now = time.monotonic_ns()
+    small = None
+    if self._sad_threshold:
+      small = cv2.resize(img, (16, 16), interpolation=cv2.INTER_AREA).astype(np.int16)
+    if (small is not None and self._last_emb is not None
+        and now - self._last_infer_ns < self._MAX_REUSE_NS
+        and int(np.abs(small - self._prev_small).sum()) < self._sad_threshold):
+      emb, label, reused = self._last_emb, self._last_label, True
+    else:
+      emb = self._engine.DetectWithArray(img, bgr)
+      label = self._engine.kNNEmbedding(emb) or 0
+      self._prev_small, self._last_emb, self._last_label = small, emb, label
+      self._last_infer_ns = now
+      reused = False
+    self._vote[self._ring[self._ring_i]] -= 1
+    self._ring[self._ring_i] = label
+    self._ring_i = (self._ring_i+1) & (len(self._ring)-1)
+    self._vote[label] += 1
+    classification = int(self._vote.argmax()) or None
     # Interpret user button presses (if any)
     debounced_buttons = self._ui.getDebouncedButtonState()
     for i, b in enumerate(debounced_buttons):
       if not b: continue
+      self._last_emb = None   # the store changes, don't reuse the cached label
       if i == 0:
         self.clear_dir()   ### Modify by Chun : clear data folder
         self._engine.clear() # Hitting button 0 resets
       else :
+        if reused:   # store the embedding of the frame that is saved, not a cached one
+          emb, reused = self._engine.DetectWithArray(img, bgr), False
         self._engine.addEmbedding(emb, i) # otherwise the button # is the class
         
         ### Modify by Chun : Save Image & Label
-        save_path = os.path.join(self.trg_folder[i-1], f'{str(self.img_nums[i-1])}.jpg')
-        img.save(save_path)
+        save_path = os.path.join(self.trg_folder[i-1], f'{str(self._next_idx[i-1])}.jpg')
+        # Queue a copy, so the image stays valid after the input buffer is
+        # reused for the next frame.
+        save_img = img.copy() if bgr else cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        # Blocks only if 32 saves are pending: the sample is already embedded
+        # and counted, so it must not be dropped.
+        self._save_q.put((save_path, save_img))
         self.img_nums[i-1] += 1
+        self._next_idx[i-1] += 1
         ### End of Modify
         
     # Hitting exactly all 4 class buttons simultaneously quits the program.
-    if sum(filter(lambda x:x, debounced_buttons[1:])) == 4 and not debounced_buttons[0]:
+    if self._ui.allClassButtonsPressed():
       self.clean_shutdown = True
       return True # return True to shut down pipeline
     return self.get_results(classification)   ### Modify by Chun : log of results
@@ -326,49 +689,103 @@ class TeachableMachineImprinting(TeachableMachine):
       if i == 0: self._engine.clear() # Hitting button 0 resets
       else : self._engine.addImage(img, i) # otherwise the button # is the class
     # Hitting exactly all 4 class buttons simultaneously quits the program.
-    if sum(filter(lambda x:x, debounced_buttons[1:])) == 4 and not debounced_buttons[0]:
+    if self._ui.allClassButtonsPressed():
       self.clean_shutdown = True
       return True # return True to shut down pipeline
     return self.visualize(classification, svg)
 
 ### Modify by Chun
 class ThreadCapture():
+  """Three stage pipeline: capture -> classify -> render.
+
+     The capture thread crops and resizes frames into a small pool
+     of preallocated model input buffers, the classify thread runs the KNN on
+     them and the main thread renders the results. Stages are connected by
+     bounded queues that drop the oldest entry when full, so a slow stage
+     never makes the others fall behind the camera.
+
+     Each input buffer is owned by exactly one stage at a time: it is taken
+     from the free list, filled, queued together with the frame it was
+     resized from, and only returned to the free list once classify is done
+     with it (or when it is dropped from the queue). A buffer is therefore
+     never rewritten while it is being classified.
+  """
+
+  _QUEUE_SIZE = 2
+  _POOL_SIZE = _QUEUE_SIZE + 2   # queued + being written + being classified
     
-  def __init__(self, knn):
-    self.frame = []
-    self.status = False
+  def __init__(self, knn, affinity=None):
     self.isStop = False
     self.knn = knn
+    self.affinity = affinity   # (capture, classify, render) CPU cores, None leaves it to the OS
     self.cap = cv2.VideoCapture(0)
+    self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))   # let the camera compress, libjpeg-turbo decodes
     self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-    self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 480)
+    self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)   # don't queue up stale frames when classify lags
+    # Camera geometry is fixed: measure one frame and build the center crop once
+    status, raw = self.cap.read()
+    h, w = raw.shape[:2] if status else (480, 640)
+    cut = (w-h)//2
+    self._crop = np.s_[:, cut:w-cut]
+    # 224x224 BGR model input buffers not currently owned by any stage
+    self._free = queue.Queue()
+    for _ in range(self._POOL_SIZE):
+      self._free.put(np.empty((224, 224, 3), np.uint8))
+    self._pre_q = queue.Queue(maxsize=self._QUEUE_SIZE)      # (frame, input buffer)
+    self._render_q = queue.Queue(maxsize=self._QUEUE_SIZE)   # (frame, classify result)
+    self._threads = []
+    self.shutdown = threading.Event()   # set when classify asks the program to quit
     
   def start(self):
-    threading.Thread(target=self.current_frame, daemon=True, args=()).start()
+    self._threads = [threading.Thread(target=self.current_frame, daemon=True, args=()),
+                     threading.Thread(target=self.run_knn, daemon=True, args=())]
+    for t in self._threads: t.start()
 
-  def stop(self):
+  def stop(self, timeout=2.0):
+    """Stops the worker threads and waits up to `timeout` seconds for each,
+       so the camera gets released before the program exits."""
     self.isStop = True
-    
-  def get_frame(self):
-    return self.status, self.frame
-  
-  def crop_frame(self):
-    h = self.frame.shape[0]
-    w = self.frame.shape[1]
-    cut = int((w-h)/2)
-    self.frame = self.frame[0:h, cut:w-cut]
+    for t in self._threads: t.join(timeout)
+
+  def get_result(self, timeout=0.1):
+    """Returns (frame, result of classify) for the newest frame, None on timeout."""
+    try:
+      return self._render_q.get(timeout=timeout)
+    except queue.Empty:
+      return None
   
   def current_frame(self):
+    if self.affinity: pin_thread(self.affinity[0])
     while(not self.isStop):
-      self.status, self.frame = self.cap.read()
-      self.crop_frame()
+      status, raw = self.cap.read()
+      if not status:
+        time.sleep(0.01)   # don't spin a core while the camera is unavailable
+        continue
+      frame = raw[self._crop]
+      try:
+        buf = self._free.get(timeout=0.1)
+      except queue.Empty:   # only when classify is stopping, re-check isStop
+        continue
+      cv2.resize(frame, (224, 224), dst=buf)   # stays BGR, the engine swaps channels
+      dropped = put_latest(self._pre_q, (frame, buf))
+      if dropped is not None: self._free.put(dropped[1])
     self.cap.release()
 
   def run_knn(self):
-    img_resize = cv2.resize(self.frame, (224, 224))
-    img = cv2.cvtColor(img_resize, cv2.COLOR_BGR2RGB)
-    img_pil = Image.fromarray(img)
-    return self.knn.classify(img_pil)
+    # Only this thread touches the engine, so classify needs no locking.
+    if self.affinity: pin_thread(self.affinity[1], nice=-5)
+    while(not self.isStop):
+      try:
+        frame, buf = self._pre_q.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      result = self.knn.classify_array(buf, bgr=True)
+      self._free.put(buf)
+      if result is True:   # all 4 class buttons pressed, signalled outside the lossy queue
+        self.shutdown.set()
+        break
+      put_latest(self._render_q, (frame, result))
 ### End of Modify
 
 def main(args):
@@ -387,6 +804,10 @@ def main(args):
                         default='output.tflite')
     parser.add_argument('--keepclasses', dest='keepclasses', action='store_true',
                         help='Whether to keep base model classes, only for imprinting method.')
+    parser.add_argument('--sadthreshold', type=int, default=0,
+                        help='Reuse the last result when the 16x16 thumbnail differs less than this from the last classified frame (0 disables), only for knn method.')
+    parser.add_argument('--affinity', type=int, nargs=3, metavar=('CAPTURE', 'CLASSIFY', 'RENDER'),
+                        help='Pin the capture, classify and render threads to these CPU cores.')
     args = parser.parse_args()
 
     # The UI differs a little depending on the system because the GPIOs
@@ -410,33 +831,35 @@ def main(args):
     print('Initialize Model...')
     if args.method == 'knn':
       # teachable = TeachableMachineKNN(args.model, ui)
-      teachable = TeachableMachineKNN_ByChun(args.model, ui)
+      teachable = TeachableMachineKNN_ByChun(args.model, ui, sad_threshold=args.sadthreshold)
     else:
       teachable = TeachableMachineImprinting(args.model, ui, args.outputmodel, args.keepclasses)
 
     ### Modify by Chun 
     # print('Start Pipeline.')
     # result = gstreamer.run_pipeline(teachable.classify)
-    stream = ThreadCapture(teachable)
+    stream = ThreadCapture(teachable, args.affinity)
     stream.start()
-    time.sleep(1)       # 等待thread擷取到攝影機影像
+    if args.affinity: pin_thread(args.affinity[2])   # after start(), so the workers don't inherit it
 
-    while(True):
+    while(not stream.shutdown.is_set()):
       
-      status, frame = stream.get_frame()
+      item = stream.get_result()   # waits briefly for the classify thread's next result
 
-      if status:
-        info, res = stream.run_knn()
+      if item is not None:
+        frame, (info, res) = item
         print(info)
         cv2.putText(frame, info, (10,40), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,0,255), 1, cv2.LINE_AA)
       
         cv2.imshow('Test', frame)
 
-        if cv2.waitKey(1)==ord('q'):
-          break
+      # Pump HighGUI events every iteration, even while classify is stalled
+      if cv2.waitKey(1)==ord('q'):
+        break
 
-    ui.wiggleLEDs(4)
     stream.stop()
+    teachable.close()
+    ui.wiggleLEDs(4)
     cv2.destroyAllWindows()
     ### End of Modify
 